@@ -5,7 +5,10 @@ Diagnoses and fixes GitHub Actions workflow failures automatically
 """
 
 import os
+import re
 import json
+import time
+import hashlib
 import subprocess
 from pathlib import Path
 from typing import Dict, List, Any, Optional
@@ -45,6 +48,108 @@ class FixSolution:
     confidence_score: float
     implementation_steps: List[str]
 
+# Normalization patterns applied to error signatures before fingerprinting,
+# so the same failure recurring in a later run maps to the same cache entry
+SIGNATURE_NORMALIZERS = [
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"), "<ts>"),
+    (re.compile(r"\b\d{2}:\d{2}:\d{2}(?:\.\d+)?\b"), "<ts>"),
+    # Runner and workspace checkout roots; the repo-relative part is kept
+    (re.compile(r"/home/runner/work/[^/\s]+/[^/\s]+/"), ""),
+    (re.compile(r"/__w/[^/\s]+/[^/\s]+/"), ""),
+    (re.compile(r"[A-Za-z]:\\a\\[^\\\s]+\\[^\\\s]+\\"), ""),
+    (re.compile(r"/workspaces/[^/\s]+/"), ""),
+    (re.compile(r"\b(?:run|job|attempt)[ _#-]?(?:id)?[:= #]*\d+\b", re.IGNORECASE), "<run>"),
+    (re.compile(r"\b(?=[0-9a-f]*\d)[0-9a-f]{7,40}\b"), "<sha>"),
+    (re.compile(r"\b\d{6,}\b"), "<id>"),
+    (re.compile(r"\s+"), " "),
+]
+
+CACHE_DIR = Path(os.environ.get("CREWAI_FIX_CACHE_DIR", "/workspaces/best/.crewai-cache"))
+CACHE_TTL_SECONDS = int(os.environ.get("CREWAI_FIX_CACHE_TTL", 7 * 24 * 3600))
+
+def normalize_error_signature(text: str) -> str:
+    """Strip timestamps, checkout roots, run ids and shas from an error message"""
+    for pattern, replacement in SIGNATURE_NORMALIZERS:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+def failure_fingerprint(failure: WorkflowFailure) -> str:
+    """Stable fingerprint of a failure that ignores run-specific details"""
+    signature = "|".join([
+        failure.workflow_name,
+        failure.job_name,
+        failure.step_name,
+        normalize_error_signature(failure.error_message),
+    ])
+    return hashlib.sha256(signature.encode("utf-8")).hexdigest()
+
+class CrewAnalysisCache:
+    """Persistent cache of crew analyses keyed by failure fingerprint"""
+    
+    def __init__(self, workspace_path: str = "/workspaces/best",
+                 cache_dir: Path = CACHE_DIR, ttl_seconds: int = CACHE_TTL_SECONDS):
+        self.workspace_path = Path(workspace_path)
+        self.cache_dir = Path(cache_dir)
+        self.ttl_seconds = ttl_seconds
+    
+    def _entry_path(self, fingerprint: str) -> Path:
+        return self.cache_dir / f"{fingerprint}.json"
+    
+    def hash_files(self, files: List[str]) -> Dict[str, Optional[str]]:
+        """Content hashes of the affected files (None if a file is missing)"""
+        hashes = {}
+        for name in sorted(set(files)):
+            path = self.workspace_path / name
+            try:
+                hashes[name] = hashlib.sha256(path.read_bytes()).hexdigest()
+            except OSError:
+                hashes[name] = None
+        return hashes
+    
+    def get(self, fingerprint: str, files: List[str]) -> Optional[Dict[str, Any]]:
+        """Return the cached entry if it is fresh and the affected files are unchanged"""
+        entry_path = self._entry_path(fingerprint)
+        try:
+            entry = json.loads(entry_path.read_text())
+        except (OSError, ValueError):
+            return None
+        
+        if time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+            self.invalidate(fingerprint)
+            return None
+        
+        if entry.get("file_hashes") != self.hash_files(files):
+            self.invalidate(fingerprint)
+            return None
+        
+        return entry
+    
+    def put(self, fingerprint: str, files: List[str], analysis: Dict[str, Any],
+            solution: FixSolution, crew_result: str) -> None:
+        """Store a successfully applied crew analysis with the post-fix file hashes"""
+        entry = {
+            "fingerprint": fingerprint,
+            "created_at": time.time(),
+            "file_hashes": self.hash_files(files),
+            "analysis": analysis,
+            "solution": solution.__dict__,
+            "crew_result": crew_result,
+        }
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._entry_path(fingerprint).with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(entry, indent=2))
+            tmp_path.replace(self._entry_path(fingerprint))
+        except OSError as e:
+            print(f"⚠️  Could not write analysis cache: {e}")
+    
+    def invalidate(self, fingerprint: str) -> None:
+        """Drop a cache entry"""
+        try:
+            self._entry_path(fingerprint).unlink()
+        except OSError:
+            pass
+
 class GitHubActionsDiagnosticTool:
     """Advanced diagnostic tool for GitHub Actions failures"""
     
@@ -380,6 +485,24 @@ def run_crewai_fix(run_id: str = "18968338593") -> bool:
     print(f"💡 Solution: {solution.description}")
     print(f"📊 Confidence: {solution.confidence_score:.0%}")
     
+    # Reuse a stored analysis when this failure has been seen before
+    cache = CrewAnalysisCache()
+    fingerprint = failure_fingerprint(failure)
+    cache_files = sorted(set(analysis["affected_files"]) | set(solution.files_to_fix))
+    cached = cache.get(fingerprint, cache_files)
+    
+    if cached:
+        print(f"♻️  Using cached CrewAI analysis ({fingerprint[:12]})")
+        print(cached["crew_result"])
+        cached_solution = FixSolution(**cached["solution"])
+        
+        if apply_fixes(cached_solution, fixer):
+            print("✅ GitHub Actions workflow fixed successfully!")
+            return True
+        
+        print("❌ Cached fix failed, re-running CrewAI analysis")
+        cache.invalidate(fingerprint)
+    
     # Create CrewAI tasks
     diagnostic_task = Task(
         description=f"""Analyze this GitHub Actions failure:
@@ -436,6 +559,9 @@ def run_crewai_fix(run_id: str = "18968338593") -> bool:
         success = apply_fixes(solution, fixer)
         
         if success:
+            # Hash the files in their fixed state, which is what a recurring
+            # failure will see; failed fixes are never cached
+            cache.put(fingerprint, cache_files, analysis, solution, str(result))
             print("✅ GitHub Actions workflow fixed successfully!")
             return True
         else:
@@ -1,8 +1,10 @@
-import os, re, math, requests, textwrap, asyncio, aiohttp
+import os, re, math, json, uuid, wave, hashlib, functools, threading, requests, textwrap, asyncio, aiohttp, subprocess
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
-from moviepy.editor import ImageClip, CompositeVideoClip, AudioFileClip
+from moviepy.editor import ImageClip, CompositeVideoClip
 
 W, H = 1080, 1920
 FPS = 30
@@ -11,6 +13,20 @@ OUT_PATH = "nws_video.mp4"
 TMP = Path("/tmp/nws")
 TMP.mkdir(exist_ok=True)
 VOICE_ID = "15bd057749e24626b06ea471c2c35b43"
+VOICE_SPEED = 0.95
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "1"))
+
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+AUDIO_CHUNK = 1 << 16          # frames processed per NumPy chunk
+TARGET_LOUDNESS_DB = -16.0     # gated RMS loudness target for the voice, dBFS
+PEAK_CEILING_DB = -1.0
+MUSIC_PATH = os.environ.get("MUSIC_PATH")
+MUSIC_GAIN_DB = -20.0          # music bed level relative to full scale
+MUSIC_DUCK_DB = -12.0          # extra attenuation while the voice is speaking
+DUCK_THRESHOLD_DB = -40.0
+DUCK_BLOCK = 1024              # sidechain envelope resolution, frames
+DUCK_SMOOTH_S = 0.25
 
 SCENES = [
     {"image": "https://www.natureswaysoil.com/images/products/NWS_001/main.jpg",
@@ -23,7 +39,7 @@ SCENES = [
 
 async def generate_tts(api_key, text, out_path):
     headers = {"X-Api-Key": api_key, "Content-Type": "application/json"}
-    payload = {"voice_id": VOICE_ID, "text": text, "speed": 0.95}
+    payload = {"voice_id": VOICE_ID, "text": text, "speed": VOICE_SPEED}
     async with aiohttp.ClientSession() as session:
         async with session.post("https://api.heygen.com/v1/audio/text_to_speech", headers=headers, json=payload) as r:
             data = await r.json()
@@ -39,13 +55,154 @@ def download_image(url, out_path):
     r.raise_for_status()
     out_path.write_bytes(r.content)
 
+def ffmpeg_binary():
+    from moviepy.config import get_setting
+    return get_setting("FFMPEG_BINARY")
+
+def decode_audio(src, out_path):
+    """Decode src once to raw float32 PCM on disk and return it memory-mapped."""
+    subprocess.run([ffmpeg_binary(), "-y", "-loglevel", "error", "-i", str(src),
+        "-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(AUDIO_CHANNELS), "-ar", str(AUDIO_FPS),
+        str(out_path)], check=True)
+    if Path(out_path).stat().st_size == 0:
+        raise RuntimeError(f"No audio decoded from {src}")
+    return np.memmap(out_path, dtype=np.float32, mode="r").reshape(-1, AUDIO_CHANNELS)
+
+_music_lock = threading.Lock()
+_music_cache = {}
+_music_files = set()
+
+def _music_key(src):
+    st = os.stat(src)
+    return hashlib.sha256(f"{os.path.abspath(src)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:16]
+
+def load_music(src):
+    """Keep a decoded music bed resident for this process (used by render_worker).
+
+    Other processes may share the decoded file: it is only ever created by
+    renaming a finished decode into place, never rewritten, so existing memory
+    maps stay valid. Renders in a process that never called this decode the
+    bed privately and delete it after mixing.
+    """
+    key = _music_key(src)
+    path = TMP / f"music-{key}.f32"
+    with _music_lock:
+        if key not in _music_cache:
+            while True:
+                if not path.exists():
+                    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+                    try:
+                        decode_audio(src, tmp)
+                        os.replace(tmp, path)
+                    finally:
+                        tmp.unlink(missing_ok=True)
+                try:
+                    music = np.memmap(path, dtype=np.float32, mode="r").reshape(-1, AUDIO_CHANNELS)
+                    break
+                except FileNotFoundError:  # released by another process meanwhile
+                    continue
+            _music_cache[key] = music
+            _music_files.add(path)
+        return _music_cache[key]
+
+def release_music():
+    """Drop resident music beds and their decoded files.
+
+    Unlinking leaves mappings held by other processes valid.
+    """
+    with _music_lock:
+        _music_cache.clear()
+        for path in _music_files:
+            path.unlink(missing_ok=True)
+        _music_files.clear()
+
+def block_stats(samples, block):
+    """Per-block mean-square power and overall peak, computed chunk by chunk."""
+    step = block * max(1, AUDIO_CHUNK // block)
+    power, peak = [], 0.0
+    for start in range(0, len(samples), step):
+        chunk = np.asarray(samples[start:start+step], dtype=np.float32)
+        peak = max(peak, float(np.abs(chunk).max()))
+        nb = -(-len(chunk) // block)
+        pad = nb * block - len(chunk)
+        if pad:
+            chunk = np.concatenate([chunk, np.zeros((pad, chunk.shape[1]), np.float32)])
+        power.append(np.square(chunk.reshape(nb, block, -1)).mean(axis=(1, 2)))
+    return np.concatenate(power), peak
+
+def voice_gain(voice):
+    """Linear gain bringing the voice to TARGET_LOUDNESS_DB without exceeding the peak ceiling.
+
+    Loudness is the mean power of 400 ms blocks above a -70 dBFS gate, a
+    simplified (unweighted) take on the EBU R128 measurement.
+    """
+    power, peak = block_stats(voice, int(AUDIO_FPS * 0.4))
+    gated = power[power > 10 ** (-70 / 10)]
+    if not len(gated) or peak == 0:
+        return 1.0
+    loudness = 10 * np.log10(gated.mean())
+    gain = 10 ** ((TARGET_LOUDNESS_DB - loudness) / 20)
+    gain = min(gain, 10 ** (PEAK_CEILING_DB / 20) / peak)
+    print(f"  Voice loudness: {loudness:.1f} dBFS → gain {20 * np.log10(gain):+.1f} dB")
+    return gain
+
+def duck_envelope(voice, gain):
+    """Per-block linear music gain, ducked wherever the (gained) voice is active."""
+    power, _ = block_stats(voice, DUCK_BLOCK)
+    level = 10 * np.log10(power * gain ** 2 + 1e-12)
+    active = (level > DUCK_THRESHOLD_DB).astype(np.float32)
+    k = max(1, int(DUCK_SMOOTH_S * AUDIO_FPS / DUCK_BLOCK))
+    held = np.convolve(active, np.ones(k, np.float32), "same") > 0
+    smooth = np.convolve(held.astype(np.float32), np.ones(k, np.float32) / k, "same")
+    return 10 ** ((MUSIC_GAIN_DB + MUSIC_DUCK_DB * smooth) / 20)
+
+def mix_audio(voice_src, out_path, music_src=None, workdir=TMP):
+    """Normalize the voice, mix in a looped, ducked music bed and write one WAV.
+
+    All processing runs over fixed-size chunks of memory-mapped PCM so memory
+    stays bounded regardless of track length. Returns the duration in seconds.
+    """
+    voice = decode_audio(voice_src, workdir / "voice.f32")
+    gain = voice_gain(voice)
+    music = envelope = None
+    if music_src:
+        with _music_lock:
+            music = _music_cache.get(_music_key(music_src))
+        if music is None:
+            music = decode_audio(music_src, workdir / "music.f32")
+        envelope = duck_envelope(voice, gain)
+        block_centers = (np.arange(len(envelope)) + 0.5) * DUCK_BLOCK
+
+    with wave.open(str(out_path), "wb") as out:
+        out.setnchannels(AUDIO_CHANNELS)
+        out.setsampwidth(2)
+        out.setframerate(AUDIO_FPS)
+        for start in range(0, len(voice), AUDIO_CHUNK):
+            chunk = np.asarray(voice[start:start+AUDIO_CHUNK], dtype=np.float32) * gain
+            if music is not None:
+                frames = np.arange(start, start + len(chunk))
+                bed = np.asarray(music[frames % len(music)], dtype=np.float32)
+                chunk += bed * np.interp(frames, block_centers, envelope).astype(np.float32)[:, None]
+            np.clip(chunk, -1.0, 1.0, out=chunk)
+            out.writeframes((chunk * 32767).astype("<i2").tobytes())
+
+    duration = len(voice) / AUDIO_FPS
+    del voice, music
+    for raw in ("voice.f32", "music.f32"):
+        (workdir / raw).unlink(missing_ok=True)
+    return duration
+
+@functools.lru_cache(maxsize=None)
+def load_font(size):
+    try:
+        return ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", size)
+    except:
+        return ImageFont.load_default()
+
 def make_caption_frame(text):
     img = Image.new("RGBA", (W, H), (0, 0, 0, 0))
     draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", FONT_SIZE)
-    except:
-        font = ImageFont.load_default()
+    font = load_font(FONT_SIZE)
     lines = textwrap.wrap(text, width=22)
     line_h = FONT_SIZE + 16
     total_h = len(lines) * line_h
@@ -57,9 +214,11 @@ def make_caption_frame(text):
             draw.text((x+dx, y+dy), line, font=font, fill=(0,0,0,200))
         draw.text((x, y), line, font=font, fill=(255,255,255,255))
         y += line_h
-    return np.array(img)
+    # Crop to the drawn text so each caption holds a text box, not a full frame
+    bbox = img.getchannel("A").getbbox() or (0, 0, 1, 1)
+    return np.array(img.crop(bbox)), bbox[:2]
 
-def make_bg_clip(image_path, duration):
+def make_bg_plate(image_path):
     img = Image.open(image_path).convert("RGB")
     ir = img.width / img.height
     tr = W / H
@@ -74,56 +233,268 @@ def make_bg_clip(image_path, duration):
     img = img.resize((W, H), Image.LANCZOS)
     overlay = Image.new("RGB", (W, H), (0,0,0))
     img = Image.blend(img, overlay, alpha=0.38)
-    return ImageClip(np.array(img)).set_duration(duration)
+    return np.array(img)
 
-def make_logo_clip(total_duration):
+def make_logo_plate():
     img = Image.new("RGBA", (W, 110), (0,0,0,0))
     draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 40)
-    except:
-        font = ImageFont.load_default()
+    font = load_font(40)
     draw.text((40, 30), "Nature's Way Soil", font=font, fill=(255,255,255,230))
-    return ImageClip(np.array(img), ismask=False).set_duration(total_duration).set_position(("left","top"))
+    return np.array(img)
 
-async def main():
+class AssetStore:
+    """Named image arrays for one render, held in process memory.
+
+    RGBA arrays are stored split into an RGB plate and a uint8 alpha mask.
+    """
+
+    def __init__(self):
+        self._views = {}
+
+    def _put_array(self, name, arr):
+        self._views[name] = arr
+
+    def put(self, name, img):
+        if img.ndim == 3 and img.shape[2] == 4:
+            self._put_array(name, np.ascontiguousarray(img[:, :, :3]))
+            self._put_array(name + ".mask", np.ascontiguousarray(img[:, :, 3]))
+        else:
+            self._put_array(name, np.ascontiguousarray(img))
+
+    def get(self, name):
+        return self._views[name], self._views.get(name + ".mask")
+
+    def close(self):
+        self._views.clear()
+
+    def unlink(self):
+        pass
+
+class SharedAssetStore(AssetStore):
+    """Named image arrays in shared memory, for multi-process renders.
+
+    The parent fills the store once; render workers attach by name and get
+    read-only NumPy views, so plates and captions are never copied or pickled
+    per worker.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.specs = {}
+        self._blocks = {}
+
+    def _put_array(self, name, arr):
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[:] = arr
+        view.setflags(write=False)
+        self._blocks[name] = shm
+        self._views[name] = view
+        self.specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+    @classmethod
+    def attach(cls, specs):
+        store = cls()
+        for name, (shm_name, shape, dtype) in specs.items():
+            try:
+                shm = shared_memory.SharedMemory(name=shm_name, track=False)
+            except TypeError:  # Python < 3.13
+                shm = shared_memory.SharedMemory(name=shm_name)
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            view.setflags(write=False)
+            store._blocks[name] = shm
+            store._views[name] = view
+            store.specs[name] = (shm_name, shape, dtype)
+        return store
+
+    def close(self):
+        self._views.clear()
+        for shm in self._blocks.values():
+            try:
+                shm.close()
+            except BufferError:  # clips still hold views; released on GC
+                pass
+
+    def unlink(self):
+        for shm in self._blocks.values():
+            shm.unlink()
+        self._blocks.clear()
+
+def build_clips(store, layout):
+    clips = []
+    for item in layout:
+        img, mask = store.get(item["asset"])
+        clip = ImageClip(img, ismask=False)
+        if mask is not None:
+            clip = clip.set_mask(ImageClip(mask.astype(np.float32) / 255, ismask=True))
+        clip = clip.set_duration(item["duration"]).set_start(item["start"])
+        if item.get("position"):
+            clip = clip.set_position(item["position"])
+        clips.append(clip)
+    return clips
+
+def render_segment(specs, layout, t0, t1, out_path):
+    store = SharedAssetStore.attach(specs)
+    try:
+        video = CompositeVideoClip(build_clips(store, layout), size=(W,H)).subclip(t0, t1)
+        video.write_videofile(out_path, fps=FPS, codec="libx264", audio=False,
+            verbose=False, logger=None)
+    finally:
+        store.close()
+    return out_path
+
+def render_parallel(store, layout, total, audio_path, out_path, workers, workdir=TMP):
+    bounds = [round(total * k / workers * FPS) / FPS for k in range(workers + 1)]
+    seg_paths = [str(workdir / f"seg{k}.mp4") for k in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_segment, store.specs, layout, bounds[k], bounds[k+1], seg_paths[k])
+                   for k in range(workers)]
+        for f in futures:
+            f.result()
+    concat_list = workdir / "segments.txt"
+    concat_list.write_text("".join(f"file '{p}'\n" for p in seg_paths))
+    mux_audio(["-f", "concat", "-safe", "0", "-i", str(concat_list)], audio_path, out_path)
+
+def mux_audio(video_input, audio_path, out_path):
+    """Copy the encoded video stream and encode the pre-mixed track alongside it."""
+    subprocess.run([ffmpeg_binary(), "-y", "-loglevel", "error", *video_input, "-i", str(audio_path),
+        "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-shortest", str(out_path)],
+        check=True)
+
+def _digest(data):
+    if not isinstance(data, bytes):
+        data = json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def manifest_path(out_path):
+    return Path(str(out_path) + ".manifest.json")
+
+def render_inputs(scenes, image_paths):
+    """Hash of every input and parameter that affects the rendered output."""
+    inputs = {
+        "render": _digest({"W": W, "H": H, "FPS": FPS, "FONT_SIZE": FONT_SIZE}),
+        "voice": _digest({"voice_id": VOICE_ID, "speed": VOICE_SPEED}),
+        "audio": _digest({"fps": AUDIO_FPS, "channels": AUDIO_CHANNELS, "loudness": TARGET_LOUDNESS_DB,
+                          "ceiling": PEAK_CEILING_DB, "music_gain": MUSIC_GAIN_DB, "duck": MUSIC_DUCK_DB,
+                          "duck_threshold": DUCK_THRESHOLD_DB, "duck_block": DUCK_BLOCK,
+                          "duck_smooth": DUCK_SMOOTH_S}),
+    }
+    if MUSIC_PATH:
+        inputs["music"] = _digest(Path(MUSIC_PATH).read_bytes())
+    for i, sc in enumerate(scenes):
+        inputs[f"scene{i}.sentences"] = _digest(sc["sentences"])
+        inputs[f"scene{i}.image"] = _digest(Path(image_paths[i]).read_bytes())
+    return inputs
+
+def changed_inputs(out_path, inputs):
+    """Names of inputs that differ from the manifest next to out_path.
+
+    Returns an empty list when the output is up to date, or None when there is
+    no usable output/manifest to compare against.
+    """
+    path = manifest_path(out_path)
+    if not Path(out_path).exists() or not path.exists():
+        return None
+    try:
+        previous = json.loads(path.read_text()).get("inputs", {})
+    except ValueError:
+        return None
+    return sorted(k for k in set(previous) | set(inputs) if previous.get(k) != inputs.get(k))
+
+def write_manifest(out_path, inputs):
+    path = manifest_path(out_path)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp.write_text(json.dumps({"output": str(out_path), "inputs": inputs}, indent=2))
+    os.replace(tmp, path)
+
+def load_secrets():
     import sys
     sys.path.insert(0, "/workspaces/best/pipeline")
     from secrets_manager import get_secrets
-    s = get_secrets()
+    return get_secrets()
+
+async def render_video(scenes, out_path=OUT_PATH, secrets=None, workdir=TMP, workers=RENDER_WORKERS):
+    """Render scenes to out_path; returns False if the manifest says it is up to date.
+
+    secrets are fetched on demand unless passed in, and workdir holds this
+    render's intermediate files so concurrent renders do not collide.
+    """
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    print("\n[0/4] Checking render manifest...")
+    image_paths = []
+    for i, sc in enumerate(scenes):
+        img_path = workdir / f"img{i}.jpg"
+        download_image(sc["image"], img_path)
+        image_paths.append(img_path)
+    inputs = render_inputs(scenes, image_paths)
+    changed = changed_inputs(out_path, inputs)
+    if changed == [] and not os.environ.get("FORCE_RENDER"):
+        print(f"  Up to date, skipping → {out_path}")
+        return False
+    if changed:
+        print(f"  Changed inputs: {', '.join(changed)}")
+    # A stale manifest must never vouch for an output this run may leave half-written
+    manifest_path(out_path).unlink(missing_ok=True)
+
+    if secrets is None:
+        secrets = load_secrets()
 
     print("\n[1/4] Generating voiceover...")
-    full_script = "  ".join(sent for sc in SCENES for sent in sc["sentences"])
-    audio_path = TMP / "voice.mp3"
-    await generate_tts(s["HEYGEN_API_KEY"], full_script, audio_path)
+    full_script = "  ".join(sent for sc in scenes for sent in sc["sentences"])
+    audio_path = workdir / "voice.mp3"
+    await generate_tts(secrets["HEYGEN_API_KEY"], full_script, audio_path)
 
-    print("\n[2/4] Loading audio...")
-    audio = AudioFileClip(str(audio_path))
-    total = audio.duration
+    print("\n[2/4] Mixing audio...")
+    mix_path = workdir / "mix.wav"
+    total = mix_audio(audio_path, mix_path, MUSIC_PATH, workdir)
     print(f"  Duration: {total:.1f}s")
 
     print("\n[3/4] Building scenes...")
-    total_sents = sum(len(sc["sentences"]) for sc in SCENES)
-    all_clips = []
+    total_sents = sum(len(sc["sentences"]) for sc in scenes)
+    # Only a multi-process render needs its assets in shared memory
+    store = SharedAssetStore() if workers > 1 else AssetStore()
+    layout = []
     t = 0
-    for i, sc in enumerate(SCENES):
+    for i, sc in enumerate(scenes):
         dur = total * len(sc["sentences"]) / total_sents
-        img_path = TMP / f"img{i}.jpg"
-        download_image(sc["image"], img_path)
-        bg = make_bg_clip(img_path, dur).set_start(t)
-        all_clips.append(bg)
+        store.put(f"bg{i}", make_bg_plate(image_paths[i]))
+        layout.append({"asset": f"bg{i}", "start": t, "duration": dur})
         seg = dur / len(sc["sentences"])
         for j, sent in enumerate(sc["sentences"]):
-            cap = ImageClip(make_caption_frame(sent), ismask=False).set_duration(seg*0.9).set_start(t + j*seg)
-            all_clips.append(cap)
+            caption, position = make_caption_frame(sent)
+            store.put(f"cap{i}_{j}", caption)
+            layout.append({"asset": f"cap{i}_{j}", "start": t + j*seg, "duration": seg*0.9,
+                           "position": position})
         t += dur
 
-    all_clips.append(make_logo_clip(total))
+    store.put("logo", make_logo_plate())
+    layout.append({"asset": "logo", "start": 0, "duration": total, "position": ("left","top")})
+
+    print(f"\n[4/4] Rendering ({workers} worker(s))...")
+    out_path = Path(out_path)
+    tmp_out = out_path.with_name(f".{out_path.stem}.{uuid.uuid4().hex}.tmp{out_path.suffix}")
+    try:
+        if workers > 1:
+            render_parallel(store, layout, total, mix_path, tmp_out, workers, workdir)
+        else:
+            video_path = workdir / "video.mp4"
+            final = CompositeVideoClip(build_clips(store, layout), size=(W,H))
+            final.write_videofile(str(video_path), fps=FPS, codec="libx264", audio=False,
+                verbose=False, logger=None)
+            mux_audio(["-i", str(video_path)], mix_path, tmp_out)
+        os.replace(tmp_out, out_path)
+    finally:
+        tmp_out.unlink(missing_ok=True)
+        store.close()
+        store.unlink()
+    write_manifest(out_path, inputs)
+    print(f"\n✅ Done! → {out_path}")
+    return True
 
-    print("\n[4/4] Rendering...")
-    final = CompositeVideoClip(all_clips, size=(W,H)).set_audio(audio)
-    final.write_videofile(OUT_PATH, fps=FPS, codec="libx264", audio_codec="aac",
-        temp_audiofile="/tmp/nws/tmp.m4a", remove_temp=True, verbose=False, logger=None)
-    print(f"\n✅ Done! → {OUT_PATH}")
+async def main():
+    await render_video(SCENES)
 
-asyncio.run(main())
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,241 @@
+"""Resident render worker for make_video.py.
+
+Keeps moviepy/NumPy/PIL imported, fonts loaded and secrets fetched, then
+renders jobs dropped into a spool directory:
+
+    python render_worker.py                     # serve
+    python render_worker.py submit B0FG38YYJ5   # queue an ASIN (or NWS_014)
+    python render_worker.py submit job.json     # queue {"scenes": [...], "out_path": ...}
+
+Jobs move incoming/ -> processing/ -> done/ or failed/, and each result file
+records the queue wait and render latency. A job in processing/ is named
+after the worker that owns it, so several workers can share one spool and
+only jobs whose owner has died are requeued.
+"""
+import os, re, sys, json, time, uuid, fcntl, shutil, socket, asyncio, hashlib, contextlib, traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import make_video
+
+SPOOL = Path(os.environ.get("RENDER_SPOOL", "/tmp/nws/spool"))
+OUTPUT_DIR = Path(os.environ.get("RENDER_OUTPUT_DIR", "."))
+CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", "2"))
+POLL_INTERVAL = 0.5
+REQUEUE_INTERVAL = 30
+HOST = socket.gethostname().replace("~", "_")
+# Unique per worker process, so a recycled pid never inherits a dead worker's jobs
+WORKER = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+SITE_URL = "https://www.natureswaysoil.com"
+REPO = Path(__file__).resolve().parent
+PRODUCTS_PATH = REPO / "config" / "top-products.json"
+SCRIPTS_PATH = REPO / "content" / "social-script-variations" / "top5-video-scripts.json"
+
+def spool_dirs():
+    dirs = {name: SPOOL / name for name in ("incoming", "processing", "done", "failed", "workers", "locks")}
+    for d in dirs.values():
+        d.mkdir(parents=True, exist_ok=True)
+    return dirs
+
+def safe_id(job_id):
+    """Restrict a job id to characters safe in file names and paths."""
+    return re.sub(r"[^A-Za-z0-9_-]", "_", str(job_id))[:64] or uuid.uuid4().hex[:12]
+
+def owner_name(job_id):
+    return f"{HOST}~{WORKER}~{job_id}.json"
+
+def parse_owner(path):
+    """(host, worker, job id) of a job file in processing/."""
+    host, worker, job_id = path.stem.split("~", 2)
+    return host, worker, job_id
+
+def worker_lock_path(dirs, host=HOST, worker=WORKER):
+    return dirs["workers"] / f"{host}~{worker}.lock"
+
+def hold_worker_lock(dirs):
+    """Lock a file for the lifetime of this process; the OS drops it when we die.
+
+    The file is locked under a temp name and then renamed, so a sweeper never
+    sees an unlocked lock file for a live worker.
+    """
+    path = worker_lock_path(dirs)
+    tmp = path.with_suffix(".tmp")
+    lock = open(tmp, "w")
+    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    tmp.rename(path)
+    return lock
+
+def release_worker_lock(dirs, lock):
+    worker_lock_path(dirs).unlink(missing_ok=True)
+    lock.close()
+
+def remove_if_unlocked(lock_path):
+    """Delete a worker lock file nobody holds; True if its worker is gone."""
+    try:
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+    lock_path.unlink(missing_ok=True)
+    return True
+
+def owner_alive(dirs, host, worker):
+    if host != HOST:
+        return True  # cannot check another machine; leave its jobs alone
+    if worker == WORKER:
+        return True
+    return not remove_if_unlocked(worker_lock_path(dirs, host, worker))
+
+def submit(job):
+    """Atomically queue a job dict and return its id."""
+    job_id = safe_id(job.get("id") or uuid.uuid4().hex[:12])
+    incoming = spool_dirs()["incoming"]
+    tmp = incoming / f".{job_id}.tmp"
+    tmp.write_text(json.dumps(dict(job, id=job_id)))
+    tmp.rename(incoming / f"{job_id}.json")
+    return job_id
+
+def scenes_for_product(key, variation=0):
+    """Build a scene list from the product catalog by ASIN or NWS product id."""
+    products = json.loads(PRODUCTS_PATH.read_text())["topProducts"]
+    scripts = json.loads(SCRIPTS_PATH.read_text())
+    for p in products:
+        if key == p["id"] or p.get("amazonUrl", "").rstrip("/").endswith(f"/dp/{key}"):
+            if p["id"] not in scripts:
+                raise ValueError(f"No video script for {p['id']}")
+            sentences = scripts[p["id"]]["variations"][variation]["scenes"]
+            return p["id"], [{"image": SITE_URL + p["productImagePath"], "sentences": sentences}]
+    raise ValueError(f"Unknown product: {key}")
+
+def resolve_job(job):
+    if job.get("asin"):
+        name, scenes = scenes_for_product(job["asin"], job.get("variation", 0))
+    else:
+        name, scenes = job["id"], job["scenes"]
+    return scenes, job.get("out_path") or str(OUTPUT_DIR / f"{name}.mp4")
+
+@contextlib.contextmanager
+def output_lock(dirs, out_path):
+    """Serialize renders of one output path across threads and workers.
+
+    A job that waited here sees the first render's manifest and is skipped.
+    """
+    key = hashlib.sha256(os.path.abspath(out_path).encode()).hexdigest()[:16]
+    with open(dirs["locks"] / f"{key}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def run_job(path, secrets, dirs):
+    _, _, job_id = parse_owner(path)
+    started = time.time()
+    result = {"id": job_id}
+    workdir = make_video.TMP / "jobs" / job_id
+    try:
+        result["queued_s"] = round(started - path.stat().st_mtime, 3)
+        job = dict(json.loads(path.read_text()), id=job_id)
+        scenes, out_path = resolve_job(job)
+        # Jobs render in-process; RENDER_CONCURRENCY alone bounds parallelism
+        with output_lock(dirs, out_path):
+            rendered = asyncio.run(make_video.render_video(scenes, out_path, secrets, workdir, workers=1))
+        result.update(status="rendered" if rendered else "skipped", out_path=out_path)
+        dest = dirs["done"]
+    except Exception as e:
+        result.update(status="failed", error=str(e), traceback=traceback.format_exc())
+        dest = dirs["failed"]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result["latency_s"] = round(time.time() - started, 3)
+    try:
+        (dest / f"{job_id}.json").write_text(json.dumps(result, indent=2))
+        path.unlink()
+    except OSError as e:
+        print(f"  [{job_id}] could not record result: {e}")
+    print(f"  [{job_id}] {result['status']} in {result['latency_s']:.1f}s (queued {result.get('queued_s', 0):.1f}s)")
+    return result
+
+def claim(dirs):
+    """Move the oldest incoming job into processing/ under this worker's name."""
+    def mtime(p):
+        try:
+            return p.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+    for path in sorted(dirs["incoming"].glob("*.json"), key=mtime):
+        target = dirs["processing"] / owner_name(safe_id(path.stem))
+        try:
+            path.rename(target)
+        except FileNotFoundError:  # claimed by another worker
+            continue
+        return target
+    return None
+
+def requeue_orphans(dirs):
+    """Return jobs whose owning worker has died to incoming/."""
+    for path in dirs["processing"].glob("*.json"):
+        try:
+            host, worker, job_id = parse_owner(path)
+        except ValueError:
+            continue
+        if owner_alive(dirs, host, worker):
+            continue
+        try:
+            path.rename(dirs["incoming"] / f"{job_id}.json")
+            print(f"  [{job_id}] requeued from dead worker {worker}")
+        except FileNotFoundError:  # requeued by another worker
+            pass
+    # Sweep lock files left by workers on this host that exited without a job
+    for lock_path in dirs["workers"].glob(f"{HOST}~*.lock"):
+        if lock_path != worker_lock_path(dirs):
+            remove_if_unlocked(lock_path)
+
+def serve():
+    dirs = spool_dirs()
+    worker_lock = hold_worker_lock(dirs)
+    try:
+        work(dirs)
+    finally:
+        release_worker_lock(dirs, worker_lock)
+
+def work(dirs):
+    requeue_orphans(dirs)
+    last_requeue = time.time()
+
+    print("Warming up...")
+    make_video.load_font(make_video.FONT_SIZE)
+    make_video.load_font(40)
+    if make_video.MUSIC_PATH:
+        make_video.load_music(make_video.MUSIC_PATH)
+    secrets = make_video.load_secrets()
+    print(f"Watching {dirs['incoming']} ({CONCURRENCY} concurrent job(s))")
+
+    try:
+        running = set()
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            while True:
+                for f in [f for f in running if f.done()]:
+                    if f.exception():
+                        print(f"  Job crashed: {f.exception()!r}")
+                running = {f for f in running if not f.done()}
+                path = claim(dirs) if len(running) < CONCURRENCY else None
+                if path:
+                    running.add(pool.submit(run_job, path, secrets, dirs))
+                    continue
+                if time.time() - last_requeue > REQUEUE_INTERVAL:
+                    requeue_orphans(dirs)
+                    last_requeue = time.time()
+                time.sleep(POLL_INTERVAL)
+    finally:
+        make_video.release_music()
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "submit":
+        arg = sys.argv[2]
+        job = json.loads(Path(arg).read_text()) if arg.endswith(".json") else {"asin": arg}
+        print(submit(job))
+    else:
+        serve()
+
+if __name__ == "__main__":
+    main()